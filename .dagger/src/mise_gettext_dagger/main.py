@@ -1,11 +1,29 @@
+import asyncio
 import dagger
 from dagger import dag, function, object_type
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
 from dataclasses import dataclass
 import re
+import functools
 from bs4 import BeautifulSoup
-from collections import defaultdict
-from typing import Iterable, List
+from typing import Callable, Dict, List, Optional, Tuple
+
+_MIRROR = "https://mirrors.ocf.berkeley.edu/gnu/"
+_BASE = _MIRROR + "gettext/"
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(["GET"])),
+))
+SESSION.headers["Accept-Encoding"] = "gzip"
+
+_VERSION_RE = re.compile(r"gettext-(?P<version>.*?)\.tar\.gz(?P<sig>\.sig)?")
+_LISTING_HREF_RE = re.compile(r'href="(?P<href>gettext-(?P<version>[^"]+?)\.tar\.gz(?P<sig>\.sig)?)"')
 
 # @object_type
 @dataclass
@@ -16,63 +34,110 @@ class GettextVersion:
 
     @staticmethod
     def mirror() -> str:
-        return "https://mirrors.ocf.berkeley.edu/gnu/"
+        return _MIRROR
 
     @staticmethod
     def base_url() -> str:
-        return GettextVersion.mirror() + "/gettext/"
+        return _BASE
 
-    @staticmethod
-    def tarball_base_url() -> str:
-        return GettextVersion.base_url() + "/gettext-%version%.tar.gz"
-    
     @staticmethod
     def from_version(version: str) -> 'GettextVersion':
         return GettextVersion(
             version=version,
-            tarball_url=GettextVersion.tarball_base_url().replace('%version%', version),
-            sig_url=GettextVersion.base_url() + f"gettext-{version}.tar.gz.sig"
+            tarball_url=f"{_BASE}gettext-{version}.tar.gz",
+            sig_url=f"{_BASE}gettext-{version}.tar.gz.sig"
         )
 
     @staticmethod
-    def get_versions() -> Iterable['GettextVersion']:
-        regex = r"gettext-(?P<version>.*?).tar.gz(?P<sig>\.sig)?"
-        res = requests.get("https://ftp.gnu.org/gnu/gettext/")
-        tree = BeautifulSoup(res.text)
-        versions = defaultdict(lambda: {})
-        for item in tree.find("table").children:
-            # print(type(item))
-            item = item.find('a')
-            if type(item) is int:
-                continue
-            if item is None:
-                continue
+    def listing_urls() -> List[str]:
+        # in order of preference, ftp.gnu.org is the canonical listing
+        return ["https://ftp.gnu.org/gnu/gettext/", GettextVersion.base_url()]
+
+    @staticmethod
+    def fetch_listing(url: str) -> Dict[str, List[Optional[str]]]:
+        res = SESSION.get(url, timeout=(3, 10))
+        res.raise_for_status()
+        versions: Dict[str, List[Optional[str]]] = {}
+        for match in _LISTING_HREF_RE.finditer(res.text):
+            has_sig = match['sig'] is not None
+            versions.setdefault(match['version'], [None, None])[1 if has_sig else 0] = match['href']
+        if not versions:
+            # listing markup changed, fall back to walking the table
+            versions = GettextVersion.parse_listing_table(res.text)
+        return versions
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def get_versions() -> Tuple['GettextVersion', ...]:
+        # Every listing host is fetched at once, but the first one in
+        # listing_urls() that succeeds always wins. version_list, and with it
+        # the release diff in create_releases, never depends on which host
+        # answered first; the fallbacks only save a round trip when it fails.
+        urls = GettextVersion.listing_urls()
+        results = {}
+
+        def fetch(url: str):
+            try:
+                results[url] = (GettextVersion.fetch_listing(url), None)
+            except Exception as e:
+                results[url] = ({}, e)
+
+        # daemon threads, so a fallback still stuck in its timeouts doesn't
+        # keep the process alive once a listing was picked
+        threads = [threading.Thread(target=fetch, args=(url,), daemon=True) for url in urls]
+        for thread in threads:
+            thread.start()
+        versions = {}
+        error = None
+        for (url, thread) in zip(urls, threads):
+            thread.join()
+            versions, e = results[url]
+            if versions:
+                break
+            error = e or error
+        if not versions:
+            raise RuntimeError(f"no gettext versions found at {', '.join(urls)}") from error
+        return tuple(
+            GettextVersion(
+                tarball_url=_BASE + tarball,
+                sig_url=_BASE + sig,
+                version=k
+            )
+            for (k, (tarball, sig)) in versions.items()
+            if tarball is not None and sig is not None
+        )
+
+    @staticmethod
+    def parse_listing_table(html: str) -> Dict[str, List[Optional[str]]]:
+        table = BeautifulSoup(html, "lxml").find("table")
+        versions: Dict[str, List[Optional[str]]] = {}
+        if table is None:
+            return versions
+        for item in table.find_all('a'):
             name = item.text
             href = item.get('href')
-            match = re.match(regex, name)
+            match = _VERSION_RE.match(name)
             if match is None:
                 continue
             match = match.groupdict()
             has_sig = match['sig'] is not None
-            versions[match['version']]['sig_url' if has_sig else 'tarball_url'] = href
-        for (k, v) in versions.items():
-            try:
-                yield GettextVersion(
-                    tarball_url=GettextVersion.base_url() + v['tarball_url'],
-                    sig_url=GettextVersion.base_url() + v['sig_url'],
-                    version=k
-                )
-            except KeyError:
-                continue
+            versions.setdefault(match['version'], [None, None])[1 if has_sig else 0] = href
+        return versions
 
 @object_type
 class MiseGettextDagger:
     @function
-    def build_version(self, version: str = "0.26") -> dagger.Directory:
-        source = self.fetch_source(GettextVersion.from_version(version))
+    async def build_version(self, version: str = "0.26", jobs: Optional[int] = None) -> dagger.Directory:
+        source = self.fetch_source(version)
+        # resolve the per-arch builds and the verified source together before packaging
+        linux_amd64, linux_aarch64, source = await asyncio.gather(
+            self.build_linux_amd64(source, jobs).sync(),
+            self.build_linux_aaarch64(source, jobs).sync(),
+            source.sync(),
+        )
         mapping = {
-            "linux-amd64": self.build_linux_amd64(source),
-            "linux-aarch64": self.build_linux_aaarch64(source),
+            "linux-amd64": linux_amd64,
+            "linux-aarch64": linux_aarch64,
             # "windows-amd64": self.build_windows_amd64(source), # broken
             "src": source
         }
@@ -89,6 +154,16 @@ class MiseGettextDagger:
     def version_list(self) -> dagger.File:
         return dag.file("versions.txt", "\n".join([v.version for v in GettextVersion.get_versions()]))
 
+    @function
+    def gpg_keyring(self, keys: List[str]) -> dagger.Directory:
+        return (
+            dag.container()
+            .from_("alpine:latest")
+            .with_exec(["apk", "add", "gnupg"])
+            .with_exec(["gpg", "--recv-keys", *keys])
+            .directory("/root/.gnupg")
+        )
+
     @function
     def fetch_tarball(self, tarball: dagger.File, signature: dagger.File, valid_keys: List[str] =[]) -> dagger.Directory:
         return (
@@ -97,17 +172,23 @@ class MiseGettextDagger:
             .with_exec(["apk", "add", "gnupg"])
             .with_file("/source.tar", tarball)
             .with_file("/signature.sig", signature)
-            .with_exec(["gpg", "--recv-keys", *valid_keys])
-            .with_exec(["gpg", "--verify", "signature.sig", "source.tar"])
-            .with_exec(["mkdir", "-p", "/src"])
-            .with_exec(["tar", "-xvf", "/source.tar", "-C", "/src", "--strip-components", "1"])
+            .with_directory("/root/.gnupg", self.gpg_keyring(valid_keys))
+            .with_exec(["sh", "-c", "gpg --verify /signature.sig /source.tar && mkdir -p /src && tar -xzf /source.tar -C /src --strip-components 1"])
             .directory("/src")
         )
 
-    def fetch_source(self, version: GettextVersion) -> dagger.Directory:
+    @function
+    def tarball(self, version: str) -> dagger.File:
+        return dag.http(GettextVersion.from_version(version).tarball_url)
+
+    @function
+    def signature(self, version: str) -> dagger.File:
+        return dag.http(GettextVersion.from_version(version).sig_url)
+
+    def fetch_source(self, version: str) -> dagger.Directory:
         return self.fetch_tarball(
-            tarball=dag.http(version.tarball_url),
-            signature=dag.http(version.sig_url),
+            tarball=self.tarball(version),
+            signature=self.signature(version),
             valid_keys=[
                 "B6301D9E1BBEAC08", "F5BE8B267C6A406D", "4F494A942E4616C2" # Bruno Haible
             ]
@@ -116,45 +197,69 @@ class MiseGettextDagger:
     
     @function
     def base_build_container(self) -> dagger.Container:
-        return dag.container().from_("debian:stable")
+        return (
+            dag.container()
+            .from_("debian:stable")
+            .with_env_variable("DEBIAN_FRONTEND", "noninteractive")
+            # debian images purge downloaded packages after install, and the apt
+            # front end deletes them on its own too, keep them in the cache volume
+            .with_exec(["sh", "-c", "rm -f /etc/apt/apt.conf.d/docker-clean"])
+            .with_new_file("/etc/apt/apt.conf.d/keep-cache", 'Binary::apt::APT::Keep-Downloaded-Packages "true";\n')
+        )
+
+    def apt_install(self, *packages: str) -> Callable[[dagger.Container], dagger.Container]:
+        def install(container: dagger.Container) -> dagger.Container:
+            return (
+                container
+                # apt holds locks inside both directories, so concurrent builds take turns
+                .with_mounted_cache("/var/cache/apt", dag.cache_volume("apt-cache"), sharing=dagger.CacheSharingMode.LOCKED)
+                .with_mounted_cache("/var/lib/apt/lists", dag.cache_volume("apt-lists"), sharing=dagger.CacheSharingMode.LOCKED)
+                .with_exec(["apt", "update"])
+                .with_exec(["apt", "install", "-y", *packages])
+                # unmount before compiling, otherwise the builds keep taking turns on the lock
+                .without_mount("/var/cache/apt")
+                .without_mount("/var/lib/apt/lists")
+            )
+        return install
 
     @function
-    def build_linux_amd64(self, source: dagger.Directory) -> dagger.Directory:
+    def build_linux_amd64(self, source: dagger.Directory, jobs: Optional[int] = None) -> dagger.Directory:
         return (
             self.base_build_container()
+            .with_(self.apt_install("build-essential", "ccache"))
+            .with_mounted_cache("/ccache", dag.cache_volume("ccache-amd64"))
+            .with_env_variable("CCACHE_DIR", "/ccache")
+            .with_env_variable("PATH", "/usr/lib/ccache:${PATH}", expand=True)
             .with_directory("/src", source)
             .with_workdir("/src")
-            .with_exec(["apt", "update"])
-            .with_exec(["apt", "install", "-y", "build-essential"])
             .with_exec(["./configure", '--prefix=/out', '--disable-shared', '--enable-static'])
-            .with_exec(["make", "install"])
+            .with_exec(["sh", "-c", f"make -j{jobs or '$(nproc)'} && make install"])
             .directory("/out")
         )
     @function
-    def build_linux_aaarch64(self, source: dagger.Directory) -> dagger.Directory:
+    def build_linux_aaarch64(self, source: dagger.Directory, jobs: Optional[int] = None) -> dagger.Directory:
         return (
             self.base_build_container()
+            .with_(self.apt_install("build-essential", "ccache", "crossbuild-essential-arm64"))
+            .with_mounted_cache("/ccache", dag.cache_volume("ccache-aarch64"))
+            .with_env_variable("CCACHE_DIR", "/ccache")
+            .with_env_variable("PATH", "/usr/lib/ccache:${PATH}", expand=True)
             .with_directory("/src", source)
             .with_workdir("/src")
-            .with_exec(["apt", "update"])
-            .with_exec(["apt", "install", "-y", "build-essential"])
-            .with_exec(["apt", "install", "-y", "crossbuild-essential-arm64"])
             .with_exec(["./configure", '--prefix=/out', "--host=arm-linux-gnueabihf", "--build=x86_64-linux-gnu", '--disable-shared', '--enable-static'])
-            .with_exec(["make", "install"])
+            .with_exec(["sh", "-c", f"make -j{jobs or '$(nproc)'} && make install"])
             .directory("/out")
         )
 
     @function
-    def build_windows_amd64(self, source: dagger.Directory) -> dagger.Directory:
+    def build_windows_amd64(self, source: dagger.Directory, jobs: Optional[int] = None) -> dagger.Directory:
         return (
             self.base_build_container()
+            .with_(self.apt_install("build-essential", "mingw-w64", "mingw-w64-tools", "mingw-w64-common", "gcc-mingw-w64-x86-64-win32"))
             .with_directory("/src", source)
             .with_workdir("/src")
-            .with_exec(["apt", "update"])
-            .with_exec(["apt", "install", "-y", "build-essential"])
-            .with_exec(["apt", "install", "-y", "mingw-w64", "mingw-w64-tools", "mingw-w64-common", "gcc-mingw-w64-x86-64-win32"])
             .with_exec(["./configure", '--prefix=/out', "--host=x86_64-w64-mingw32", "--target=x86_64-w64-mingw32", "--build=x86_64-linux-gnu", '--disable-shared', '--enable-static'])
-            .with_exec(["make", "install"])
+            .with_exec(["sh", "-c", f"make -j{jobs or '$(nproc)'} && make install"])
             .directory("/out")
         )
     # @function